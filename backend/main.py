@@ -2,7 +2,7 @@ from typing import Union
 from fastapi import FastAPI, HTTPException, Depends, Request
 from pydantic import BaseModel
 import hashlib
-from utils.utils import create_connection, create_table, insert_user, verbose_exception_message
+from utils.utils import create_connection, create_table, add_column, insert_user, verbose_exception_message
 from jose import jwt
 import datetime 
 from fastapi.responses import JSONResponse
@@ -74,8 +74,23 @@ def startup_event():
     """
     # Default database location
     database = Path('./sqlite/db/pythonsqlite.db')
+    # Two worlds can never share a port on the same host
+    sql_create_world_port_index = """
+    CREATE UNIQUE INDEX IF NOT EXISTS WorldHostPort ON WorldTable (Host, Port);
+    """
     if database.is_file():
         print("Database exists")
+        # Add the shared instance placement columns to older databases
+        conn = create_connection(database)
+        if add_column(conn, "WorldTable", "Host", "Host varchar(255)"):
+            # Older worlds each have their own instance, placeholder machine names are made unique
+            conn.execute("UPDATE WorldTable SET Host = MachineName WHERE ID IN (SELECT MIN(ID) FROM WorldTable GROUP BY MachineName)")
+            conn.execute("UPDATE WorldTable SET Host = MachineName || '-' || ID WHERE Host IS NULL")
+            conn.commit()
+        add_column(conn, "WorldTable", "Port", "Port INTEGER DEFAULT 25565")
+        add_column(conn, "WorldTable", "MemoryMB", "MemoryMB INTEGER DEFAULT 1024")
+        create_table(conn, sql_create_world_port_index)
+        conn.close()
     else:
         print("Database does not exist, generating default roles and users") 
         # Connect to the local SQLite database
@@ -107,15 +122,28 @@ def startup_event():
         insert_user(conn, visitor)
 
         # Create Worlds table
-        
+        # Host is the instance the world runs on, several worlds can share a host on different ports
         sql_create_worlds_table = """ 
-        CREATE TABLE IF NOT EXISTS WorldTable (ID INTEGER PRIMARY KEY, WorldName varchar(255), ServerStatus INTEGER, IPAddress varchar(255), MachineName varchar(255));
+        CREATE TABLE IF NOT EXISTS WorldTable (ID INTEGER PRIMARY KEY, WorldName varchar(255), ServerStatus INTEGER, IPAddress varchar(255), MachineName varchar(255), Host varchar(255), Port INTEGER DEFAULT 25565, MemoryMB INTEGER DEFAULT 1024);
         """
         create_table(conn, sql_create_worlds_table)
+        create_table(conn, sql_create_world_port_index)
         
         # Close the connection
         conn.close()
 
+def get_hosts(cur):
+    """
+    Collect the ports and memory reserved on each instance that still has a running world,
+    instances whose worlds are all stopped have been deleted.
+    """
+    hosts = {}
+    for host, ip, port, memory in cur.execute("SELECT Host, IPAddress, Port, MemoryMB FROM WorldTable WHERE Host IN (SELECT Host FROM WorldTable WHERE ServerStatus != ?)", (ServerStatus.OFF.value,)).fetchall():
+        hosts.setdefault(host, {"ip": ip, "ports": set(), "reserved": 0})
+        hosts[host]["ports"].add(port)
+        hosts[host]["reserved"] += memory
+    return hosts
+
 def verify_token(req: Request):
     try:
         token = req.headers["token"]
@@ -158,11 +186,13 @@ async def servers(
         # Create a cursor object
         cur = conn.cursor()
         # Get all worlds from the database
-        cur.execute("SELECT * FROM WorldTable")
+        cur.execute("SELECT ID, WorldName, ServerStatus, IPAddress, Port FROM WorldTable")
         rows = cur.fetchall()
         worlds = []
         for row in rows:
-            worlds.append({"id":row[0],"worldName": row[1], "ipAddress": row[3], "serverStatus": row[2]})
+            # Instances that are still being created have no IP address yet
+            ipAddress = "{}:{}".format(row[3], row[4]) if row[3] else None
+            worlds.append({"id":row[0],"worldName": row[1], "ipAddress": ipAddress, "serverStatus": row[2]})
         return JSONResponse(status_code=200, content=json.dumps(worlds)) 
     else:
         return JSONResponse(status_code=401, content={"error": "You do not have permission to view this list"})
@@ -177,20 +207,36 @@ async def create_world(
         database = Path('./sqlite/db/pythonsqlite.db')
         # Connect to the local SQLite database
         conn = create_connection(database)
-        # Insert the new world into the Worlds table if it doesn't already exist and the user has permission to do so
-        # data = pipeline.gcp_integrator(settings_file='./pipeline/settings.conf').create_instance()
-        # ipAddress = data.ip
-        # machineName = data.name
-        ipAddress = 'joseph.fix.this'
-        machineName = 'josephbot'
         try:
+            settings = pipeline.get_settings('./pipeline/settings.conf')
+            base_port = pipeline.get_setting(settings, 'base_port')
             cur = conn.cursor()
+            hosts = get_hosts(cur)
+            # Pack the world onto the instance with the best fitting free capacity
+            # data = pipeline.gcp_integrator(settings_file='./pipeline/settings.conf').place_world(hosts)
+            data = pipeline.pick_host(hosts, settings)
+            if data is None:
+                # Nothing fits, fall back to a new placeholder instance that no other world uses
+                taken = [row[0] for row in cur.execute("SELECT Host FROM WorldTable").fetchall()]
+                name = 'josephbot'
+                count = 1
+                while name in taken:
+                    count += 1
+                    name = 'josephbot{}'.format(count)
+                data = {"name": name, "ip": 'joseph.fix.this', "port": base_port, "memory": pipeline.get_setting(settings, 'world_memory_mb')}
+            ipAddress = data["ip"]
+            host = data["name"]
+            port = data["port"]
+            # The machine name is also where the world is stored, keep it unique for worlds sharing a host
+            machineName = host if port == base_port else "{}-{}".format(host, port)
+            # Start the world's server on its port of the host
+            # pipeline.gcp_integrator(settings_file='./pipeline/settings.conf').load_instance(machineName, host, port, data["memory"])
             # Insert the new world into the Worlds table with the ID of the next available ID, if an ID exists
-            cur.execute("INSERT INTO WorldTable (WorldName, IPAddress, ServerStatus, MachineName) VALUES (?, ?, ?, ?)", (world.worldName, ipAddress, ServerStatus.ON.value, machineName))
+            cur.execute("INSERT INTO WorldTable (WorldName, IPAddress, ServerStatus, MachineName, Host, Port, MemoryMB) VALUES (?, ?, ?, ?, ?, ?, ?)", (world.worldName, ipAddress, ServerStatus.ON.value, machineName, host, port, data["memory"]))
             ID = cur.lastrowid
             conn.commit()
             # Return the new world's ID, name
-            return {"id": ID, "name": world.worldName, "ipAddress": ipAddress, "serverStatus": ServerStatus.PENDING.value}
+            return {"id": ID, "name": world.worldName, "ipAddress": "{}:{}".format(ipAddress, port), "serverStatus": ServerStatus.PENDING.value}
         except Exception as e:
             verbose_exception_message()
             return {"message": "Exception occured, Error: " + repr(e)}
@@ -213,10 +259,15 @@ async def delete_world(
         conn = create_connection(database)
         # Create a cursor object
         cur = conn.cursor()
-        # Get the machine name of the world to be deleted if it exists
-        # machine_name = cur.execute("SELECT MachineName FROM WorldTable WHERE ID = ?", (world_id)).fetchone()[0]
-        # Send a delete request to the pipeline to delete the world
-        # pipeline.gcp_integrator(settings_file='./pipeline/settings.conf').delete_instance(machine_name)
+        # Get the machine name, host and port of the world to be deleted if it exists
+        # machine_name, host, port, status = cur.execute("SELECT MachineName, Host, Port, ServerStatus FROM WorldTable WHERE ID = ?", (world_id,)).fetchone()
+        # A stopped world's server is already gone, and so is its host once no world on it is running
+        # if status != ServerStatus.OFF.value:
+        #     # Stop the world's server so its port is free for the next world
+        #     pipeline.gcp_integrator(settings_file='./pipeline/settings.conf').stop_server(host, port)
+        #     # Delete the host once no other world on it is still running
+        #     if cur.execute("SELECT COUNT(*) FROM WorldTable WHERE Host = ? AND ID != ? AND ServerStatus != ?", (host, world_id, ServerStatus.OFF.value)).fetchone()[0] == 0:
+        #         pipeline.gcp_integrator(settings_file='./pipeline/settings.conf').delete_instance(host)
         # Delete the world from the gcp bucket
         # pipeline.gcp_integrator(settings_file='./pipeline/settings.conf').delete_file('worlds/{machine_name}/world.zip'.format(machine_name=machine_name))
         # Delete the world from the Worlds table if it exists and the user has permission to do so
@@ -242,10 +293,13 @@ async def stop_world(
         conn = create_connection(database)
         # Create a cursor object
         cur = conn.cursor()
-        # Get the machine name of the world to be stopped if it exists
-        # machine_name = cur.execute("SELECT MachineName FROM WorldTable WHERE ID = ?", (world_id)).fetchone()[0]
-        # Send a stop request to the pipeline to stop the world
-        # data = pipeline.gcp_integrator(settings_file='./pipeline/settings.conf').delete_instance(machine_name)
+        # Get the host and port of the world to be stopped if it exists
+        # host, port = cur.execute("SELECT Host, Port FROM WorldTable WHERE ID = ?", (world_id,)).fetchone()
+        # Send a stop request to the pipeline to stop only the server on the world's port
+        # pipeline.gcp_integrator(settings_file='./pipeline/settings.conf').stop_server(host, port)
+        # Delete the host once no other world on it is still running
+        # if cur.execute("SELECT COUNT(*) FROM WorldTable WHERE Host = ? AND ID != ? AND ServerStatus != ?", (host, world_id, ServerStatus.OFF.value)).fetchone()[0] == 0:
+        #     pipeline.gcp_integrator(settings_file='./pipeline/settings.conf').delete_instance(host)
         # Stop the world in the Worlds table if it exists and the user has permission to do so
         cur.execute("UPDATE WorldTable SET ServerStatus = ? WHERE ID = ?", (ServerStatus.OFF.value, world_id))
         conn.commit()
@@ -268,10 +322,16 @@ async def load_world(
         conn = create_connection(database)
         # Create a cursor object
         cur = conn.cursor()
-        # Get the machine associated with the world, this is the also the world_name to be loaded
-        # world_name = cur.execute("SELECT MachineName FROM WorldTable WHERE ID = ?", (world_id)).fetchone()[0]
-        # Send a load request to the pipeline to load the world
-        # data = pipeline.gcp_integrator(settings_file='./pipeline/settings.conf').load_instance(world_name)
+        # Get the world_name to be loaded, with the host, port and memory reserved for it
+        # world_name, host, port, memory = cur.execute("SELECT MachineName, Host, Port, MemoryMB FROM WorldTable WHERE ID = ?", (world_id,)).fetchone()
+        # integrator = pipeline.gcp_integrator(settings_file='./pipeline/settings.conf')
+        # The host is deleted once all of its worlds are stopped, place the world again if it is gone
+        # if host not in [x[0] for x in integrator.get_running_info()]:
+        #     data = integrator.place_world(get_hosts(cur), memory)
+        #     host, port = data["name"], data["port"]
+        #     cur.execute("UPDATE WorldTable SET Host = ?, Port = ?, IPAddress = ? WHERE ID = ?", (host, port, data["ip"], world_id))
+        # Send a load request to the pipeline to start the world's server on its port of the host
+        # integrator.load_instance(world_name, host, port, memory)
         cur.execute("UPDATE WorldTable SET ServerStatus = ? WHERE ID = ?", (ServerStatus.ON.value, world_id))
         conn.commit()
         return JSONResponse(status_code=200, content={"message": "World loaded", "success": True})
@@ -10,6 +10,53 @@ from google.api_core.extended_operation import ExtendedOperation
 
 # settings_file = "./settings.conf"
 
+# Placement settings used when settings.conf leaves them out, one instance per world
+DEFAULT_SETTINGS = {
+    "placement": "dedicated",
+    "host_memory_mb": "1024",
+    "world_memory_mb": "1024",
+    "base_port": "25565",
+    "max_worlds_per_host": "1",
+}
+
+def get_settings(settings_file):
+    with open(settings_file, 'r') as f:
+        settings = f.read()
+    return {**DEFAULT_SETTINGS, **dict(x.split("=") for x in settings.split('\n') if x)}
+
+def get_setting(settings, key):
+    return int(settings[key])
+
+def pick_host(hosts, settings, memory_mb=None):
+    """ Pick a running instance with room for one more world.
+    :param hosts: dict of instance name -> {"ip": str, "ports": set of ports in use, "reserved": MB reserved}
+    :param settings: settings dict, see settings.conf
+    :param memory_mb: memory to reserve for the world, defaults to world_memory_mb
+    :return: {"name", "ip", "port", "memory"} or None if nothing fits
+    """
+    if memory_mb is None:
+        memory_mb = get_setting(settings, 'world_memory_mb')
+    if settings['placement'] != 'shared':
+        return None
+    host_memory = get_setting(settings, 'host_memory_mb')
+    base_port = get_setting(settings, 'base_port')
+    ports = range(base_port, base_port + get_setting(settings, 'max_worlds_per_host'))
+    best = None
+    for name, host in sorted(hosts.items()):
+        free = host_memory - host['reserved']
+        if free < memory_mb:
+            continue
+        port = next((p for p in ports if p not in host['ports']), None)
+        if port is None:
+            continue
+        # Best fit, the host left with the least free memory wins so that
+        # emptier instances stay free for bigger worlds
+        score = free - memory_mb
+        if best is None or score < best[0]:
+            best = (score, {"name": name, "ip": host['ip'], "port": port, "memory": memory_mb})
+    return best[1] if best else None
+
+
 def wait_for_extended_operation(operation: ExtendedOperation, verbose_name: str = "operation", timeout: int = 300) -> Any:
     result = operation.result(timeout=timeout)
     if operation.error_code:
@@ -30,10 +77,6 @@ def wait_for_extended_operation(operation: ExtendedOperation, verbose_name: str
 
 class gcp_integrator:
     def __init__(self, settings_file):
-        def get_settings(settings_file):
-            with open(settings_file, 'r') as f:
-                settings = f.read()
-            return dict(x.split("=") for x in settings.split('\n'))
         self.settings = get_settings(settings_file)
         self.get_running_info()
     
@@ -120,6 +163,60 @@ class gcp_integrator:
         c = instance_client.get(project=project_id, zone=zone, instance=instance_name)
         return {"name":c.name, "ip":c.network_interfaces[0].access_configs[0].nat_i_p}
 
+    def place_world(self, hosts, memory_mb=None):
+        """ Pack a world onto a running instance, creating a new instance only when nothing fits.
+        :param hosts: dict of instance name -> {"ip": str, "ports": set of ports in use, "reserved": MB reserved}
+        :return: {"name", "ip", "port", "memory"}
+        """
+        if memory_mb is None:
+            memory_mb = get_setting(self.settings, 'world_memory_mb')
+        running = [x[0] for x in self.get_running_info()]
+        hosts = {name: host for name, host in hosts.items() if name in running}
+        placement = pick_host(hosts, self.settings, memory_mb)
+        if placement is None:
+            data = self.create_instance()
+            placement = {"name": data["name"], "ip": data["ip"], "port": get_setting(self.settings, 'base_port'), "memory": memory_mb}
+        return placement
+
+    def get_worlds(self, machine_name):
+        """ Read the worlds an instance serves from its "worlds" metadata, "world_name:port:memory" separated by spaces.
+        :return: ({port: (world_name, memory)}, instance metadata)
+        """
+        project_id, zone = self.settings['project_id'], self.settings['zone']
+        instance_client = compute_v1.InstancesClient()
+        metadata = instance_client.get(project=project_id, zone=zone, instance=machine_name).metadata
+        worlds = {}
+        for item in metadata.items:
+            if item.key == "worlds":
+                for world in item.value.split():
+                    world_name, port, memory = world.split(":")
+                    worlds[int(port)] = (world_name, int(memory))
+        return worlds, metadata
+
+    def set_worlds(self, machine_name, worlds, metadata):
+        """ Write the worlds an instance serves, startup.sh starts and stops servers to match. """
+        project_id, zone = self.settings['project_id'], self.settings['zone']
+        instance_client = compute_v1.InstancesClient()
+        items = [item for item in metadata.items if item.key != "worlds"]
+        value = " ".join("{}:{}:{}".format(world_name, port, memory) for port, (world_name, memory) in sorted(worlds.items()))
+        items.append(compute_v1.Items(key="worlds", value=value))
+        metadata.items = items
+        operation = instance_client.set_metadata(project=project_id, zone=zone, instance=machine_name, metadata_resource=metadata)
+        wait_for_extended_operation(operation, "metadata update")
+        return True
+
+    def load_instance(self, world_name, machine_name, port, memory):
+        """ Start a world's server on its port of the instance with memory MB of heap. """
+        worlds, metadata = self.get_worlds(machine_name)
+        worlds[port] = (world_name, memory)
+        return self.set_worlds(machine_name, worlds, metadata)
+
+    def stop_server(self, machine_name, port):
+        """ Stop the server on a port of the instance, leaving the other worlds running. """
+        worlds, metadata = self.get_worlds(machine_name)
+        worlds.pop(port, None)
+        return self.set_worlds(machine_name, worlds, metadata)
+
     def delete_instance(self, machine_name):
         project_id, zone = self.settings['project_id'], self.settings['zone']
         instance_client = compute_v1.InstancesClient()
@@ -1,6 +1,37 @@
 #! /bin/bash
 sudo apt-get update -y; sudo apt install openjdk-17-jre-headless -y; sudo apt install unzip; sudo apt install screen -y; sudo apt install nano -y;
-echo "eula=true" > eula.txt
 
 wget https://piston-data.mojang.com/v1/objects/f69c284232d7c7580bd89a5a4931c3581eae1378/server.jar
-java -Xms1024M -Xmx1024M -jar server.jar nogui
\ No newline at end of file
+
+# The backend lists the worlds to serve in the "worlds" instance metadata as
+# world_name:port:memory entries separated by spaces, one server runs per entry
+WORLDS=http://metadata.google.internal/computeMetadata/v1/instance/attributes/worlds
+
+start_world() {
+    mkdir -p worlds/$1
+    (
+        cd worlds/$1
+        echo "eula=true" > eula.txt
+        if grep -q "^server-port=" server.properties 2>/dev/null; then
+            sed -i "s/^server-port=.*/server-port=$2/" server.properties
+        else
+            echo "server-port=$2" >> server.properties
+        fi
+        screen -dmS world-$2 java -Xms$3M -Xmx$3M -jar ../../server.jar nogui
+    )
+}
+
+while true; do
+    worlds=$(curl -sf -H "Metadata-Flavor: Google" $WORLDS)
+    # Start the servers of newly added worlds
+    for world in $worlds; do
+        IFS=: read name port memory <<< "$world"
+        screen -list | grep -q "\.world-$port\s" || start_world $name $port $memory
+    done
+    # Stop the servers of removed worlds, stop saves the world before exiting
+    for session in $(screen -list | grep -o "\.world-[0-9]*" | cut -c2-); do
+        port=${session#world-}
+        echo " $worlds " | grep -q ":$port:" || screen -S $session -X stuff $'stop\r'
+    done
+    sleep 5
+done
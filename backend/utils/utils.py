@@ -31,6 +31,26 @@ def create_table(conn, create_table_sql):
     except Error as e:
         print(e)
 
+def add_column(conn, table, column, column_sql):
+    """ add a column to an existing table if it is missing
+    :param conn: Connection object
+    :param table: table name
+    :param column: column name
+    :param column_sql: column definition, e.g. "Port INTEGER DEFAULT 25565"
+    :return: True if the column was added
+    """
+    try:
+        c = conn.cursor()
+        columns = [row[1] for row in c.execute("PRAGMA table_info({})".format(table))]
+        if column in columns:
+            return False
+        c.execute("ALTER TABLE {} ADD COLUMN {}".format(table, column_sql))
+        conn.commit()
+        return True
+    except Error as e:
+        print(e)
+    return False
+
 def insert_user(conn, sql):
     """ create a new user table row
     :param conn: Connection object